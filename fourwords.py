@@ -2,157 +2,213 @@
 import sys
 import os
 import re
+import pickle
 import random
 import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-def extract_vocabulary_from_usfm(file_path):
-    """Extract vocabulary from a USFM file, preserving capitalization patterns."""
-    vocabulary = {}
+def _compile_for_content(pattern):
+    """Compile pattern for any text and for pure-ASCII text, indexed by content.isascii().
+    
+    On ASCII-only content re.ASCII doesn't change what \\w or \\b match, but skips
+    the Unicode character tables and scans noticeably faster. It does change \\s,
+    which without it also matches the \\x1c-\\x1f separators, so patterns
+    compiled here write [\\s\\x1c-\\x1f] where they mean Unicode whitespace.
+    """
+    return (re.compile(pattern), re.compile(pattern, re.ASCII))
+
+# Words (letters only) that are not the name of a USFM tag like \v, \p or
+# \q1. The leading character class lets the regex engine skip ahead quickly;
+# the lookbehind then checks the word boundary before it
+_WORD_RES = _compile_for_content(r'[a-zA-Z](?<![\w\\][a-zA-Z])[a-zA-Z]*\b')
+_CAP_TOKEN_RES = _compile_for_content(r'([.!?])|([A-Z](?<![\w\\][A-Z])[a-zA-Z]*\b)')
+_ID_CLEAN_RE = re.compile(r'\\id\s+([A-Z0-9]+).*')
+# Positions needing a space: between a word character and punctuation or a
+# backslash, and between punctuation or a quote and a word character
+_SPACING_RE = re.compile(r'(?<=\w)(?=[.!?;:,\\])|(?<=[.!?;:,"])(?=\w)')
+# Everything the transform touches: spacing positions, an \id tag with the
+# rest of its line, and words (letters only) that are not part of USFM tags
+_TOKEN_RES = _compile_for_content(
+    r'(?P<space>(?<=\w)(?=[.!?;:,\\])|(?<=[.!?;:,"])(?=\w))'
+    r'|(?P<id>\\id[\s\x1c-\x1f]+[^\n]*)'
+    r'|(?P<word>(?<!\\[a-zA-Z])\b[a-zA-Z]+\b)'
+)
+
+# USFM file suffixes, in the platform's filename case like glob matches them
+_USFM_SUFFIXES = tuple(os.path.normcase(suffix) for suffix in ('.usfm', '.SFM'))
+
+def extract_vocabulary_from_usfm(file_path, counts, originals):
+    """Extract vocabulary from a USFM file, preserving capitalization patterns.
     
+    Word counts are accumulated into counts in place, and originals records the
+    capitalized spelling of words that preserve capitalization. Returns the
+    file content so callers can reuse it.
+    """
     with open(file_path, 'r', encoding='utf-8') as file:
         content = file.read()
     
-    # Remove USFM tags but keep the text
-    # This regex matches USFM tags like \v 1, \p, \q1, etc.
-    text_only = re.sub(r'\\[a-zA-Z]+[0-9]*\s*(?:\d+\s*)?', ' ', content)
-    
-    # Split into sentences to help identify sentence-starting words
-    sentences = re.split(r'[.!?]+', text_only)
-    
-    for sentence in sentences:
-        # Find all words in the sentence
-        words = re.findall(r'\b[a-zA-Z]+\b', sentence.strip())
+    is_ascii = content.isascii()
+    word_re = _WORD_RES[is_ascii]
+    
+    # Count words entirely in C: find them, lowercase them and tally them
+    # without running Python code per word
+    file_counts = Counter(map(str.lower, word_re.findall(content)))
+    
+    # Only capitalized words can preserve capitalization, so only they and
+    # the sentence terminators are visited in Python, in one token stream.
+    # A word starts a sentence if no other word appears between it and the
+    # last terminator; that is only checked for the first capitalized word
+    # after a terminator, since any later one follows that word
+    sentence_start = 0
+    for match in _CAP_TOKEN_RES[is_ascii].finditer(content):
+        if match.lastindex == 1:
+            sentence_start = match.end()
+            continue
+        word = match.group(2)
         
-        for i, word in enumerate(words):
+        # Always preserve if it's a proper noun (starts with capital and not first word)
+        # Also preserve if it's all caps (acronym)
+        if (sentence_start is None
+                or word_re.search(content, sentence_start, match.start())
+                or (len(word) > 1 and word.isupper())):
             word_lower = word.lower()
-            
-            # Determine if this word should preserve capitalization
-            preserve_caps = False
-            
-            # Always preserve if it's a proper noun (starts with capital and not first word)
-            if word[0].isupper() and i > 0:
-                preserve_caps = True
-            # Also preserve if it's all caps (acronym)
-            elif word.isupper() and len(word) > 1:
-                preserve_caps = True
-            
-            # Store the word with its capitalization pattern
-            if word_lower not in vocabulary:
-                vocabulary[word_lower] = {
-                    'original': word if preserve_caps else word_lower,
-                    'preserve_caps': preserve_caps,
-                    'count': 1
-                }
-            else:
-                vocabulary[word_lower]['count'] += 1
-                # If we see a capitalized version that's not sentence-initial, preserve it
-                if preserve_caps and not vocabulary[word_lower]['preserve_caps']:
-                    vocabulary[word_lower]['original'] = word
-                    vocabulary[word_lower]['preserve_caps'] = True
-    
-    return vocabulary
+            # If we see a capitalized version that's not sentence-initial, preserve it
+            if word_lower not in originals:
+                originals[sys.intern(word_lower)] = word
+        sentence_start = None
+    
+    # Merge into the shared counts. New words are interned once on insertion
+    # so every table keyed by them shares the one key object
+    for word_lower, count in file_counts.items():
+        total = counts.get(word_lower)
+        if total is None:
+            counts[sys.intern(word_lower)] = count
+        else:
+            counts[word_lower] = total + count
+    
+    return content
+
+def nth_nonsense_word(n, char_list):
+    """Spell out n as a 4-letter nonsense word: a 4-digit number in base len(char_list)."""
+    base = len(char_list)
+    return (char_list[n // base ** 3 % base] + char_list[n // base ** 2 % base]
+            + char_list[n // base % base] + char_list[n % base])
 
-def generate_unique_nonsense_words(chars, num_words):
-    """Generate unique 4-letter nonsense words from given characters."""
+def create_lexicon(counts, originals, chars):
+    """Create a lexicon mapping real words to nonsense words made from chars.
+    
+    Each entry is a tuple of the nonsense word to emit for a lowercase
+    occurrence, for a capitalized occurrence, and the bare nonsense word, so
+    capitalization is resolved once per word rather than per occurrence.
+    """
     # Clean the character input - remove brackets if present
     if chars.startswith('[') and chars.endswith(']'):
         chars = chars[1:-1]
     
-    char_list = list(chars)
-    words = set()
+    # Drop repeated characters so every combination index is a distinct word
+    char_list = list(dict.fromkeys(chars))
     
     # Ensure we can generate enough unique words
+    num_words = len(counts)
     max_possible = len(char_list) ** 4
     if num_words > max_possible:
         print(f"Warning: Requested {num_words} words but only {max_possible} unique combinations possible")
         num_words = max_possible
     
-    while len(words) < num_words:
-        word = ''.join(random.choice(char_list) for _ in range(4))
-        words.add(word)
+    # A random selection of distinct combination indices keeps the mapping
+    # arbitrary; each one is spelled out only when it is assigned
+    indices = random.sample(range(max_possible), num_words)
     
-    return list(words)
-
-def create_lexicon(vocabulary, nonsense_words):
-    """Create a lexicon mapping real words to nonsense words."""
     lexicon = {}
-    vocab_items = list(vocabulary.items())
-    
     # Sort by frequency (most common words get consistent nonsense words)
-    vocab_items.sort(key=lambda x: x[1]['count'], reverse=True)
+    words_by_count = sorted(counts, key=counts.__getitem__, reverse=True)
     
-    for i, (word_lower, word_info) in enumerate(vocab_items):
-        if i < len(nonsense_words):
-            lexicon[word_lower] = nonsense_words[i]
+    for i, word_lower in enumerate(words_by_count):
+        if i < num_words:
+            nonsense_word = nth_nonsense_word(indices[i], char_list)
         else:
             # If we run out of nonsense words, generate more
-            additional_word = ''.join(random.choice(list(nonsense_words[0])) for _ in range(4))
-            lexicon[word_lower] = additional_word
+            nonsense_word = ''.join(random.choice(char_list) for _ in range(4))
+        
+        original = originals.get(word_lower)
+        if original is not None:
+            # Proper nouns and acronyms keep their casing wherever they appear
+            fixed = nonsense_word
+            if original[0].isupper():
+                fixed = fixed.capitalize()
+            if original.isupper():
+                fixed = fixed.upper()
+            lexicon[word_lower] = (fixed, fixed, nonsense_word)
+        else:
+            lexicon[word_lower] = (nonsense_word, nonsense_word.capitalize(), nonsense_word)
     
     return lexicon
 
-def transform_usfm_content(content, lexicon, vocabulary):
+def transform_usfm_content(content, lexicon):
     """Transform USFM content using the lexicon while preserving formatting."""
-    def replace_word(match):
-        word = match.group(0)
-        word_lower = word.lower()
-        
-        # Check if this word is part of an \id tag
-        start_pos = match.start()
-        # Look backwards to see if we're in an \id tag
-        preceding_text = content[:start_pos]
-        
-        # Find the last \id tag before this position
-        id_matches = list(re.finditer(r'\\id\s+', preceding_text))
-        if id_matches:
-            last_id_match = id_matches[-1]
-            # Check if there's a newline between the \id tag and current word
-            text_after_id = preceding_text[last_id_match.end():]
-            if '\n' not in text_after_id:
-                # We're still on the same line as \id, so preserve this word
-                return word
-        
-        if word_lower in lexicon:
-            replacement = lexicon[word_lower]
-            
-            # Apply original capitalization pattern
-            if word_lower in vocabulary and vocabulary[word_lower]['preserve_caps']:
-                # Use the preserved capitalization pattern
-                original = vocabulary[word_lower]['original']
-                if original[0].isupper():
-                    replacement = replacement.capitalize()
-                if original.isupper():
-                    replacement = replacement.upper()
-            elif word[0].isupper():
-                replacement = replacement.capitalize()
-            elif word.isupper():
-                replacement = replacement.upper()
-            
+    # Replacements by exact spelling, so each distinct spelling is lowercased
+    # and looked up in the lexicon only once
+    replacements = {}
+    
+    def transform_token(match):
+        kind = match.lastgroup
+        if kind == 'word':
+            word = match.group(0)
+            replacement = replacements.get(word)
+            if replacement is None:
+                forms = lexicon.get(word.lower())
+                replacement = word if forms is None else forms['A' <= word[0] <= 'Z']
+                replacements[word] = replacement
             return replacement
         
-        return word
-    
-    # Replace words while preserving USFM tags and punctuation
-    # This regex finds words (letters only) that are not part of USFM tags
-    result = re.sub(r'(?<!\\[a-zA-Z])\b[a-zA-Z]+\b', replace_word, content)
-    
-    # Clean up \id lines - keep only the book code, remove everything after
-    result = re.sub(r'\\id\s+([A-Z0-9]+).*', r'\\id \1', result)
-    
-    # Ensure proper spacing around punctuation
-    # Add space before punctuation if there isn't one
-    result = re.sub(r'(\w)([.!?;:,])', r'\1 \2', result)
-    # Add space after punctuation if there isn't one (but not at end of line)
-    result = re.sub(r'([.!?;:,])(\w)', r'\1 \2', result)
-    
-    # Add space after quotes
-    result = re.sub(r'"(\w)', r'" \1', result)
+        if kind == 'space':
+            # Ensure proper spacing around punctuation, quotes and backslashes
+            return ' '
+        
+        # Words on an \id line are preserved; keep only the book code
+        id_line = _ID_CLEAN_RE.sub(r'\\id \1', match.group(0))
+        return _SPACING_RE.sub(' ', id_line)
     
-    # Add space before backslash that comes immediately after a word
-    result = re.sub(r'(\w)\\', r'\1 \\', result)
+    # Words, \id lines and spacing are all handled in a single pass that
+    # builds the output once instead of rewriting the document per rule
+    return _TOKEN_RES[content.isascii()].sub(transform_token, content)
+
+def load_vocabulary_cache(cache_file, cache_key):
+    """Load (counts, originals) cached for cache_key, or None if missing or stale."""
+    # A corrupt or foreign cache file can make unpickling raise almost anything,
+    # and it only means the vocabulary has to be extracted again
+    try:
+        with open(cache_file, 'rb') as f:
+            cached_key, counts, originals = pickle.load(f)
+    except Exception:
+        return None
+    
+    if (cached_key != cache_key or not isinstance(counts, dict)
+            or not isinstance(originals, dict)):
+        return None
+    return counts, originals
+
+def save_vocabulary_cache(cache_file, cache_key, counts, originals):
+    """Save the vocabulary extracted for cache_key for reuse by later runs."""
+    with open(cache_file, 'wb') as f:
+        pickle.dump((cache_key, counts, originals), f, protocol=5)
+
+# Lexicon for transform worker processes, set once per worker
+_worker_lexicon = None
+
+def _init_transform_worker(lexicon):
+    """Install the lexicon in a transform worker process."""
+    global _worker_lexicon
+    _worker_lexicon = lexicon
+
+def _transform_one(content, output_file):
+    """Transform one file's content in a worker process and write it out."""
+    transformed_content = transform_usfm_content(content, _worker_lexicon)
     
-    return result
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(transformed_content)
 
 def process_usfm_directory(input_dir, output_dir, chars):
     """Process all USFM files in a directory."""
@@ -162,8 +218,15 @@ def process_usfm_directory(input_dir, output_dir, chars):
     # Create output directory
     output_path.mkdir(exist_ok=True)
     
-    # Find all USFM files
-    usfm_files = list(input_path.glob('*.usfm')) + list(input_path.glob('*.SFM'))
+    # Find all USFM files in a single directory scan; the entries also carry
+    # the stat results used for the vocabulary cache. Suffixes are compared
+    # after os.path.normcase, so they are case-insensitive where glob's are.
+    # Like Path.glob('*.usfm'), names starting with a dot are included
+    with os.scandir(input_path) as entries:
+        usfm_entries = [entry for entry in entries
+                        if os.path.normcase(entry.name).endswith(_USFM_SUFFIXES)
+                        and entry.is_file()]
+    usfm_files = [Path(entry.path) for entry in usfm_entries]
     
     if not usfm_files:
         print(f"No USFM files found in {input_dir}")
@@ -171,53 +234,56 @@ def process_usfm_directory(input_dir, output_dir, chars):
     
     print(f"Found {len(usfm_files)} USFM files")
     
-    # Extract vocabulary from all files
-    all_vocabulary = {}
-    for usfm_file in usfm_files:
-        print(f"Extracting vocabulary from {usfm_file.name}...")
-        file_vocab = extract_vocabulary_from_usfm(usfm_file)
-        
-        # Merge vocabularies
-        for word_lower, word_info in file_vocab.items():
-            if word_lower in all_vocabulary:
-                all_vocabulary[word_lower]['count'] += word_info['count']
-                # Preserve caps if either instance suggests it
-                if word_info['preserve_caps'] and not all_vocabulary[word_lower]['preserve_caps']:
-                    all_vocabulary[word_lower]['original'] = word_info['original']
-                    all_vocabulary[word_lower]['preserve_caps'] = True
-            else:
-                all_vocabulary[word_lower] = word_info.copy()
-    
-    print(f"Total unique words found: {len(all_vocabulary)}")
-    
-    # Generate nonsense words
-    print("Generating nonsense words...")
-    nonsense_words = generate_unique_nonsense_words(chars, len(all_vocabulary))
+    # Reuse the vocabulary from a previous run if no input file has changed,
+    # identified by name, modification time and size
+    cache_file = output_path / '.vocab_cache.pkl'
+    cache_key = []
+    for entry in usfm_entries:
+        stat = entry.stat()
+        cache_key.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    cached_vocabulary = load_vocabulary_cache(cache_file, cache_key)
+    
+    contents = {}
+    if cached_vocabulary is not None:
+        print(f"Reusing cached vocabulary from {cache_file}")
+        word_counts, originals = cached_vocabulary
+        for usfm_file in usfm_files:
+            with open(usfm_file, 'r', encoding='utf-8') as f:
+                contents[usfm_file] = f.read()
+    else:
+        # Extract vocabulary from all files into one shared vocabulary
+        # File contents are kept so the transform phase doesn't read them again
+        word_counts = {}
+        originals = {}
+        for usfm_file in usfm_files:
+            print(f"Extracting vocabulary from {usfm_file.name}...")
+            contents[usfm_file] = extract_vocabulary_from_usfm(usfm_file, word_counts, originals)
+        save_vocabulary_cache(cache_file, cache_key, word_counts, originals)
+    
+    print(f"Total unique words found: {len(word_counts)}")
     
     # Create lexicon
     print("Creating lexicon...")
-    lexicon = create_lexicon(all_vocabulary, nonsense_words)
+    lexicon = create_lexicon(word_counts, originals, chars)
     
-    # Save lexicon to file
+    # Save lexicon to file, built up front and handed over in one write
     lexicon_file = output_path / 'lexicon.txt'
+    lexicon_text = ''.join(f"{real_word}\t{nonsense_word}\n"
+                           for real_word, (_, _, nonsense_word) in sorted(lexicon.items()))
     with open(lexicon_file, 'w', encoding='utf-8') as f:
-        for real_word, nonsense_word in sorted(lexicon.items()):
-            f.write(f"{real_word}\t{nonsense_word}\n")
+        f.write(lexicon_text)
     print(f"Lexicon saved to {lexicon_file}")
     
-    # Transform each USFM file
-    for usfm_file in usfm_files:
-        print(f"Transforming {usfm_file.name}...")
-        
-        with open(usfm_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        transformed_content = transform_usfm_content(content, lexicon, all_vocabulary)
-        
-        # Write transformed file
-        output_file = output_path / usfm_file.name
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(transformed_content)
+    # Transform the files in parallel; each worker receives the lexicon once
+    # through the initializer rather than with every task
+    output_files = [output_path / usfm_file.name for usfm_file in usfm_files]
+    num_workers = min(len(usfm_files), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_transform_worker,
+                             initargs=(lexicon,)) as executor:
+        print(f"Transforming {len(usfm_files)} files...")
+        results = executor.map(_transform_one, [contents[f] for f in usfm_files], output_files)
+        for usfm_file, _ in zip(usfm_files, results):
+            print(f"Transformed {usfm_file.name}")
     
     print(f"All files transformed and saved to {output_dir}")
 